@@ -7,6 +7,7 @@ This module handles OAuth2 authentication with Gmail API using custom token mana
 
 import os
 import pickle
+from datetime import datetime, timedelta, timezone
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -27,29 +28,66 @@ class GmailAuthManager:
         ]
         self.credentials_path = 'credentials.json'
         self.token_path = 'token.pickle'
+        # Unpickled credentials, reused until the token file changes on disk
+        self._creds_cache = None
+        self._creds_mtime = 0
+        # Gmail service built for the credentials it was created with
+        self._service = None
+        self._service_credentials = None
+        # Refresh access tokens this long before they expire
+        self.refresh_margin = timedelta(minutes=10)
+        # Authenticated IMAP connection, reused while it stays alive
+        self._imap_conn = None
     
     def _load_saved_credentials(self):
         """Load previously saved credentials if they exist."""
-        if not os.path.exists(self.token_path):
+        try:
+            mtime = os.stat(self.token_path).st_mtime
+        except OSError:
             return None
+        
+        if mtime == self._creds_mtime:
+            return self._creds_cache
             
         with open(self.token_path, 'rb') as token:
             try:
-                return pickle.load(token)
+                credentials = pickle.load(token)
             except Exception:
-                return None
+                credentials = None
+        
+        self._creds_cache = credentials
+        self._creds_mtime = mtime
+        return credentials
     
     def _save_credentials(self, credentials):
         """Save credentials for future use."""
         with open(self.token_path, 'wb') as token:
             pickle.dump(credentials, token)
+        self._creds_cache = credentials
+        self._creds_mtime = os.stat(self.token_path).st_mtime
+    
+    def _is_fresh(self, credentials) -> bool:
+        """Check that credentials are valid and not about to expire."""
+        if not credentials.valid:
+            return False
+        if credentials.expiry is None:
+            return True
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - now > self.refresh_margin
     
     def initialize_gmail_service(self):
         """Initialize and return an authorized Gmail API service instance."""
         credentials = self._load_saved_credentials()
         
-        if not credentials or not credentials.valid:
-            if credentials and credentials.expired and credentials.refresh_token:
+        # Reuse the service while it is bound to the current, fresh token
+        if (self._service is not None and credentials is self._service_credentials
+                and self._is_fresh(credentials)):
+            return self._service
+        
+        if not credentials or not self._is_fresh(credentials):
+            if credentials and credentials.refresh_token:
+                # Refresh ahead of expiry so API calls never wait on it
                 credentials.refresh(Request())
             else:
                 if not os.path.exists(self.credentials_path):
@@ -65,10 +103,26 @@ class GmailAuthManager:
                 
             self._save_credentials(credentials)
         
-        return build('gmail', 'v1', credentials=credentials)
+        # Use the discovery document bundled with googleapiclient rather
+        # than fetching it over HTTP
+        self._service = build(
+            'gmail', 'v1', credentials=credentials,
+            cache_discovery=False, static_discovery=True
+        )
+        self._service_credentials = credentials
+        return self._service
     
     def setup_imap_connection(self):
         """Create and return an authenticated IMAP connection."""
+        # Reuse the existing connection if the server still answers
+        if self._imap_conn is not None:
+            try:
+                if self._imap_conn.noop()[0] == 'OK':
+                    return self._imap_conn
+            except (imaplib.IMAP4.error, OSError):
+                pass
+            self.close_imap()
+        
         credentials = self._load_saved_credentials()
         if not credentials:
             raise ValueError("No valid credentials found. Please authenticate first.")
@@ -80,4 +134,15 @@ class GmailAuthManager:
         auth_string = f'user={credentials.client_id}\1auth=Bearer {credentials.token}\1\1'
         imap_conn.authenticate('XOAUTH2', lambda x: auth_string)
         
-        return imap_conn
\ No newline at end of file
+        self._imap_conn = imap_conn
+        return imap_conn
+    
+    def close_imap(self):
+        """Log out of and drop the cached IMAP connection."""
+        if self._imap_conn is None:
+            return
+        try:
+            self._imap_conn.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        self._imap_conn = None
\ No newline at end of file
@@ -5,39 +5,119 @@ Email Data Store Manager
 Handles database operations for storing and retrieving email data.
 """
 
+import ast
+import json
 import os
 import sqlite3
-from datetime import datetime
-from typing import List, Dict, Optional
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Iterator, List, Dict, Optional
+import pandas as pd
+
+def _timestamp(value: Any) -> Optional[int]:
+    """Convert a datetime or ISO 8601 string to a Unix timestamp."""
+    try:
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        # Naive dates come from '-0000' Date headers, which RFC 5322 defines as UTC
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp())
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def days_ago(days: int, now: Optional[int] = None) -> int:
+    """Return the Unix timestamp of the moment a number of days before now."""
+    if now is None:
+        now = int(time.time())
+    return now - days * 86400
 
 class EmailDataStore:
     """Manages email storage and retrieval operations."""
     
+    # Map rule condition fields to database column names
+    RULE_FIELD_COLUMNS = {
+        'From': 'sender',
+        'Subject': 'subject',
+        'Message': 'content',
+        'Date received': 'received_ts'
+    }
+    
     def __init__(self, db_path: str = 'email_store.db'):
         self.db_path = db_path
+        # A single long-lived connection in autocommit mode; transactions are
+        # opened explicitly around writes. The lock serialises access since
+        # the connection may be shared between Streamlit script threads.
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            self.db_path, isolation_level=None, check_same_thread=False
+        )
+        self._conn.row_factory = sqlite3.Row
+        # Bumped on every committed write so readers can cache between writes
+        self._version = 0
+        self._configure_connection()
         self.initialize_database()
     
+    def _configure_connection(self):
+        """Apply the per-connection PRAGMAs."""
+        # These settings live on the connection, not in the database file
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-20000")
+        if self.db_path != ':memory:':
+            self._conn.execute("PRAGMA mmap_size=268435456")
+    
+    @contextmanager
+    def _transaction(self):
+        """Run the enclosed statements in a single write transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._version += 1
+    
     def initialize_database(self):
         """Create database tables if they don't exist."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
+        with self._lock:
+            # auto_vacuum only takes effect before the first table is created
+            self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # WAL lets readers proceed while a write is in progress and is
+            # persisted in the file, so setting it once here is enough
+            if self.db_path != ':memory:':
+                self._conn.execute("PRAGMA journal_mode=WAL")
+        
+        with self._transaction() as conn:
             # Create emails table
-            cursor.execute("""
+            conn.execute("""
                 CREATE TABLE IF NOT EXISTS emails (
                     message_id TEXT PRIMARY KEY,
                     subject TEXT,
                     sender TEXT,
                     recipient TEXT,
                     received_date TIMESTAMP,
+                    received_ts INTEGER,
                     content TEXT,
-                    is_read BOOLEAN,
-                    labels TEXT
-                )
+                    is_read BOOLEAN
+                ) WITHOUT ROWID
+            """)
+            
+            # Create email labels table, one row per (email, label) pair
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS email_labels (
+                    message_id TEXT,
+                    label TEXT,
+                    PRIMARY KEY (message_id, label)
+                ) WITHOUT ROWID
             """)
             
             # Create rules table
-            cursor.execute("""
+            conn.execute("""
                 CREATE TABLE IF NOT EXISTS rules (
                     rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
                     name TEXT,
@@ -47,53 +127,225 @@ class EmailDataStore:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            
-            conn.commit()
+        
+        self._migrate_rule_encoding()
+        self._migrate_received_timestamps()
+        self._migrate_labels()
+        self._migrate_emails_without_rowid()
+        
+        with self._transaction() as conn:
+            # Back the ORDER BY clauses in get_emails/get_rules, date
+            # conditions and sender lookups. Emails are ordered by the integer
+            # timestamp, since ISO strings with different UTC offsets don't
+            # sort chronologically
+            conn.execute("DROP INDEX IF EXISTS idx_emails_received_date")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_emails_received_ts ON emails(received_ts DESC)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_emails_sender ON emails(sender)"
+            )
+            # Superseded index from when rules were matched in SQL
+            conn.execute("DROP INDEX IF EXISTS idx_emails_sender_lower")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_rules_created_at ON rules(created_at DESC)"
+            )
+            # Nothing looks emails up by label yet; the primary key covers
+            # the per-message label rewrites
+            conn.execute("DROP INDEX IF EXISTS idx_email_labels_label")
+    
+    def _migrate_rule_encoding(self):
+        """Rewrite rules stored as Python literals (schema version 0) as JSON."""
+        with self._transaction() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+                return
+            rows = conn.execute("SELECT rule_id, conditions, actions FROM rules").fetchall()
+            for row in rows:
+                try:
+                    conditions = json.dumps(ast.literal_eval(row['conditions']))
+                    actions = json.dumps(ast.literal_eval(row['actions']))
+                except (SyntaxError, ValueError) as e:
+                    print(f"Error migrating rule {row['rule_id']}: {e}")
+                    continue
+                conn.execute(
+                    "UPDATE rules SET conditions = ?, actions = ? WHERE rule_id = ?",
+                    (conditions, actions, row['rule_id'])
+                )
+            conn.execute("PRAGMA user_version = 1")
+    
+    def _migrate_received_timestamps(self):
+        """Add and backfill the integer received_ts column (schema version 2)."""
+        with self._transaction() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= 2:
+                return
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(emails)")}
+            if 'received_ts' not in columns:
+                conn.execute("ALTER TABLE emails ADD COLUMN received_ts INTEGER")
+            # Backfill with the same conversion store_emails uses
+            rows = conn.execute(
+                "SELECT message_id, received_date FROM emails WHERE received_ts IS NULL"
+            ).fetchall()
+            conn.executemany(
+                "UPDATE emails SET received_ts = ? WHERE message_id = ?",
+                [(_timestamp(row['received_date']), row['message_id']) for row in rows]
+            )
+            conn.execute("PRAGMA user_version = 2")
+    
+    def _migrate_labels(self):
+        """Move comma-separated labels into email_labels (schema version 3)."""
+        with self._transaction() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= 3:
+                return
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(emails)")}
+            if 'labels' in columns:
+                rows = conn.execute(
+                    "SELECT message_id, labels FROM emails WHERE labels != ''"
+                ).fetchall()
+                conn.executemany(
+                    "INSERT OR IGNORE INTO email_labels (message_id, label) VALUES (?, ?)",
+                    ((row['message_id'], label) for row in rows for label in row['labels'].split(','))
+                )
+                try:
+                    conn.execute("ALTER TABLE emails DROP COLUMN labels")
+                except sqlite3.OperationalError:
+                    # DROP COLUMN needs SQLite 3.35+; the column is simply left unused
+                    pass
+            conn.execute("PRAGMA user_version = 3")
+    
+    def _migrate_emails_without_rowid(self):
+        """Rebuild the emails table as a WITHOUT ROWID table (schema version 4)."""
+        with self._transaction() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= 4:
+                return
+            table_sql = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'emails'"
+            ).fetchone()['sql']
+            if 'WITHOUT ROWID' not in table_sql.upper():
+                # Dropping the old table also drops its indexes; they are
+                # recreated by initialize_database once migrations are done
+                conn.execute("""
+                    CREATE TABLE emails_new (
+                        message_id TEXT PRIMARY KEY,
+                        subject TEXT,
+                        sender TEXT,
+                        recipient TEXT,
+                        received_date TIMESTAMP,
+                        received_ts INTEGER,
+                        content TEXT,
+                        is_read BOOLEAN
+                    ) WITHOUT ROWID
+                """)
+                conn.execute("""
+                    INSERT INTO emails_new (
+                        message_id, subject, sender, recipient,
+                        received_date, received_ts, content, is_read
+                    )
+                    SELECT message_id, subject, sender, recipient,
+                           received_date, received_ts, content, is_read
+                    FROM emails
+                    WHERE message_id IS NOT NULL
+                """)
+                conn.execute("DROP TABLE emails")
+                conn.execute("ALTER TABLE emails_new RENAME TO emails")
+            conn.execute("PRAGMA user_version = 4")
+    
+    def version(self) -> int:
+        """Return a counter that changes whenever stored data changes."""
+        return self._version
+    
+    def close(self):
+        """Refresh query planner statistics and close the connection."""
+        with self._lock:
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
     
     def store_email(self, email_data: Dict) -> bool:
         """Store a new email in the database."""
+        return self.store_emails([email_data])
+    
+    def store_emails(self, emails: List[Dict]) -> bool:
+        """Store a batch of emails in a single transaction."""
+        rows = (
+            (
+                e['message_id'],
+                e['subject'],
+                e['sender'],
+                e['recipient'],
+                e['received_date'],
+                _timestamp(e['received_date']),
+                e['content'],
+                e['is_read']
+            )
+            for e in emails
+        )
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT OR REPLACE INTO emails (
+            with self._transaction() as conn:
+                # Upsert updates existing rows in place instead of deleting
+                # and reinserting them as INSERT OR REPLACE does
+                # Metadata-only fetches carry no content, so the stored body
+                # is kept rather than blanked
+                conn.executemany("""
+                    INSERT INTO emails (
                         message_id, subject, sender, recipient,
-                        received_date, content, is_read, labels
+                        received_date, received_ts, content, is_read
                     ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    email_data['message_id'],
-                    email_data['subject'],
-                    email_data['sender'],
-                    email_data['recipient'],
-                    email_data['received_date'],
-                    email_data['content'],
-                    email_data['is_read'],
-                    ','.join(email_data.get('labels', []))
-                ))
+                    ON CONFLICT(message_id) DO UPDATE SET
+                        subject = excluded.subject,
+                        sender = excluded.sender,
+                        recipient = excluded.recipient,
+                        received_date = excluded.received_date,
+                        received_ts = excluded.received_ts,
+                        content = COALESCE(excluded.content, emails.content),
+                        is_read = excluded.is_read
+                """, rows)
+                self._replace_labels(conn, {e['message_id']: e.get('labels', []) for e in emails})
                 return True
         except Exception as e:
-            print(f"Error storing email: {e}")
+            print(f"Error storing emails: {e}")
             return False
     
+    def iter_emails(self, limit: Optional[int] = None) -> Iterator[Dict]:
+        """Yield emails from the database, newest first."""
+        # A negative LIMIT means no limit, so both cases share one cached statement
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM emails ORDER BY received_ts DESC LIMIT ?",
+                (limit if limit else -1,)
+            )
+        
+        # Hold the lock per chunk rather than for the generator's lifetime
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(100)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    
     def get_emails(self, limit: Optional[int] = None) -> List[Dict]:
         """Retrieve emails from the database."""
-        query = "SELECT * FROM emails ORDER BY received_date DESC"
-        if limit:
-            query += f" LIMIT {limit}"
-            
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(query)
-            
-            return [dict(row) for row in cursor.fetchall()]
+        return list(self.iter_emails(limit))
+    
+    def get_emails_df(self, limit: Optional[int] = None) -> pd.DataFrame:
+        """Retrieve emails as a DataFrame with one typed column per field."""
+        with self._lock:
+            df = pd.read_sql_query(
+                "SELECT * FROM emails ORDER BY received_ts DESC LIMIT ?",
+                self._conn,
+                params=(limit if limit else -1,)
+            )
+        
+        text_columns = ['message_id', 'subject', 'sender', 'recipient', 'content']
+        df[text_columns] = df[text_columns].astype('string')
+        df['is_read'] = df['is_read'].astype(bool)
+        df['received_date'] = pd.to_datetime(df['received_ts'], unit='s', utc=True)
+        return df
     
     def update_email_status(self, message_id: str, is_read: bool) -> bool:
         """Update the read status of an email."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
+            with self._transaction() as conn:
+                conn.execute(
                     "UPDATE emails SET is_read = ? WHERE message_id = ?",
                     (is_read, message_id)
                 )
@@ -102,15 +354,26 @@ class EmailDataStore:
             print(f"Error updating email status: {e}")
             return False
     
+    def _replace_labels(self, conn: sqlite3.Connection, labels_by_id: Dict[str, List[str]]):
+        """Replace the label rows of the given emails within a transaction."""
+        conn.executemany(
+            "DELETE FROM email_labels WHERE message_id = ?",
+            ((message_id,) for message_id in labels_by_id)
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO email_labels (message_id, label) VALUES (?, ?)",
+            (
+                (message_id, label)
+                for message_id, labels in labels_by_id.items()
+                for label in labels
+            )
+        )
+    
     def update_email_labels(self, message_id: str, labels: List[str]) -> bool:
         """Update the labels of an email."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE emails SET labels = ? WHERE message_id = ?",
-                    (','.join(labels), message_id)
-                )
+            with self._transaction() as conn:
+                self._replace_labels(conn, {message_id: labels})
                 return True
         except Exception as e:
             print(f"Error updating email labels: {e}")
@@ -119,16 +382,15 @@ class EmailDataStore:
     def store_rule(self, rule_data: Dict) -> bool:
         """Store a new rule in the database."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
+            with self._transaction() as conn:
+                conn.execute("""
                     INSERT INTO rules (name, match_type, conditions, actions)
                     VALUES (?, ?, ?, ?)
                 """, (
                     rule_data['name'],
                     rule_data['match_type'],
-                    str(rule_data['conditions']),
-                    str(rule_data['actions'])
+                    json.dumps(rule_data['conditions']),
+                    json.dumps(rule_data['actions'])
                 ))
                 return True
         except Exception as e:
@@ -137,19 +399,17 @@ class EmailDataStore:
     
     def get_rules(self) -> List[Dict]:
         """Retrieve all rules from the database."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM rules ORDER BY created_at DESC")
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM rules ORDER BY created_at DESC")
             
             rules = []
             for row in cursor.fetchall():
                 rule_dict = dict(row)
                 try:
-                    # Convert string representations back to lists/dicts
-                    rule_dict['conditions'] = eval(rule_dict['conditions'])
-                    rule_dict['actions'] = eval(rule_dict['actions'])
-                except (SyntaxError, ValueError) as e:
+                    # Convert JSON representations back to lists/dicts
+                    rule_dict['conditions'] = json.loads(rule_dict['conditions'])
+                    rule_dict['actions'] = json.loads(rule_dict['actions'])
+                except (TypeError, ValueError) as e:
                     print(f"Error parsing rule data: {e}")
                     continue
                 rules.append(rule_dict)
@@ -158,9 +418,8 @@ class EmailDataStore:
     def delete_rule(self, rule_id: int) -> bool:
         """Delete a rule from the database."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM rules WHERE rule_id = ?", (rule_id,))
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM rules WHERE rule_id = ?", (rule_id,))
                 return True
         except Exception as e:
             print(f"Error deleting rule: {e}")
@@ -7,103 +7,186 @@ Handles email fetching and processing operations using Gmail API.
 
 import base64
 import email
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
-from datetime import datetime
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 from typing import List, Dict, Optional
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import Resource
+from googleapiclient.http import HttpRequest, build_http
 
 class EmailHandler:
     """Manages email operations using Gmail API."""
     
+    # Map folder names to Gmail label IDs
+    FOLDER_LABELS = {
+        'inbox': 'INBOX',
+        'spam': 'SPAM',
+        'trash': 'TRASH',
+        'archive': None  # Removing INBOX label effectively archives the message
+    }
+    
+    # Gmail rejects batch HTTP requests with more than 100 calls
+    BATCH_GET_LIMIT = 100
+    
+    # Batch requests sent concurrently when fetching messages
+    FETCH_WORKERS = 4
+    
+    # Maximum number of message ids accepted by a single batchModify call
+    BATCH_MODIFY_LIMIT = 1000
+    
+    # Largest decoded message body kept, in bytes
+    MAX_BODY_BYTES = 64 * 1024
+    
     def __init__(self, service: Resource):
         self.service = service
+        # httplib2 connections are not thread-safe, so each thread that
+        # modifies messages gets its own authorized connection
+        self._local = threading.local()
+        # Lower-cased label name -> label id, filled lazily from labels().list()
+        self._label_cache: Dict[str, str] = {}
+    
+    def _thread_http(self, credentials) -> AuthorizedHttp:
+        """Return the calling thread's authorized HTTP connection."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            # build_http() applies the client library's default socket timeout
+            http = AuthorizedHttp(credentials, http=build_http())
+            self._local.http = http
+        return http
+    
+    def _execute(self, request: HttpRequest) -> Dict:
+        """Execute an API request over the calling thread's HTTP connection."""
+        return request.execute(http=self._thread_http(request.http.credentials))
     
-    def fetch_recent_emails(self, max_results: int = 25) -> List[Dict]:
-        """Fetch recent emails from Gmail."""
+    def fetch_recent_emails(self, max_results: int = 25, need_body: bool = True) -> List[Dict]:
+        """Fetch recent emails from Gmail, optionally skipping message bodies."""
         try:
             # Get messages from Gmail API
-            results = self.service.users().messages().list(
+            list_request = self.service.users().messages().list(
                 userId='me',
                 maxResults=max_results,
                 labelIds=['INBOX']
-            ).execute()
+            )
+            results = self._execute(list_request)
             
             messages = results.get('messages', [])
-            emails = []
+            parsed = {}
             
-            for message in messages:
-                msg_data = self.service.users().messages().get(
-                    userId='me',
-                    id=message['id'],
-                    format='full'
-                ).execute()
-                
-                # Extract email details
-                headers = msg_data['payload']['headers']
-                subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
-                sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-                recipient = next((h['value'] for h in headers if h['name'].lower() == 'to'), '')
-                date_str = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
-                
-                # Parse email body
-                body = self._extract_email_body(msg_data['payload'])
-                
-                # Create email object
-                email_obj = {
-                    'message_id': message['id'],
-                    'subject': subject,
-                    'sender': sender,
-                    'recipient': recipient,
-                    'received_date': self._parse_date(date_str),
-                    'content': body,
-                    'is_read': 'UNREAD' not in msg_data['labelIds'],
-                    'labels': msg_data['labelIds']
+            def collect(request_id, response, exception):
+                if exception is not None:
+                    print(f"Error fetching message {request_id}: {exception}")
+                    return
+                parsed[request_id] = self._parse_message(response, need_body)
+            
+            if need_body:
+                get_params = {'format': 'full'}
+            else:
+                get_params = {
+                    'format': 'metadata',
+                    'metadataHeaders': ['Subject', 'From', 'To', 'Date']
                 }
-                
-                emails.append(email_obj)
             
-            return emails
+            # Fetch messages in batched HTTP round trips of up to
+            # BATCH_GET_LIMIT requests each
+            batches = []
+            for start in range(0, len(messages), self.BATCH_GET_LIMIT):
+                batch = self.service.new_batch_http_request(callback=collect)
+                for message in messages[start:start + self.BATCH_GET_LIMIT]:
+                    batch.add(
+                        self.service.users().messages().get(
+                            userId='me',
+                            id=message['id'],
+                            **get_params
+                        ),
+                        request_id=message['id']
+                    )
+                batches.append(batch)
+            
+            # Overlap the batch round trips, each on its thread's own connection;
+            # a single batch reuses this thread's connection from the listing
+            credentials = list_request.http.credentials
+            if len(batches) == 1:
+                batches[0].execute(http=self._thread_http(credentials))
+            else:
+                with ThreadPoolExecutor(max_workers=self.FETCH_WORKERS) as executor:
+                    list(executor.map(
+                        lambda batch: batch.execute(http=self._thread_http(credentials)),
+                        batches
+                    ))
+            
+            # Keep the listing order regardless of which batch finished first
+            return [parsed[m['id']] for m in messages if m['id'] in parsed]
         
         except Exception as e:
             print(f"Error fetching emails: {e}")
             return []
     
+    def _parse_message(self, msg_data: Dict, need_body: bool = True) -> Dict:
+        """Build an email object from a Gmail API message resource."""
+        # Extract email details
+        headers = {h['name'].lower(): h['value'] for h in msg_data['payload']['headers']}
+        subject = headers.get('subject', '')
+        sender = headers.get('from', '')
+        recipient = headers.get('to', '')
+        date_str = headers.get('date', '')
+        
+        # Parse email body; None tells the data store to keep any stored body
+        body = self._extract_email_body(msg_data['payload']) if need_body else None
+        
+        received_date = self._parse_date(date_str)
+        
+        # Create email object
+        return {
+            'message_id': msg_data['id'],
+            'subject': subject,
+            'sender': sender,
+            'recipient': recipient,
+            'received_date': received_date,
+            'content': body,
+            'is_read': 'UNREAD' not in msg_data['labelIds'],
+            'labels': msg_data['labelIds']
+        }
+    
     def _extract_email_body(self, payload: Dict) -> str:
         """Extract email body from payload."""
         if 'body' in payload and payload['body'].get('data'):
-            return base64.urlsafe_b64decode(payload['body']['data']).decode()
+            return self._decode_body(payload['body']['data'])
         
         if 'parts' in payload:
             for part in payload['parts']:
                 if part['mimeType'] == 'text/plain' and part['body'].get('data'):
-                    return base64.urlsafe_b64decode(part['body']['data']).decode()
+                    return self._decode_body(part['body']['data'])
         
         return ''
     
+    def _decode_body(self, data: str) -> str:
+        """Decode a base64url body, keeping at most MAX_BODY_BYTES of it."""
+        # Every 4 base64 characters decode to 3 bytes, so only the prefix
+        # that fits in the cap is decoded; a character split at the cut is
+        # replaced rather than failing the whole body
+        prefix = data[:self.MAX_BODY_BYTES // 3 * 4]
+        return base64.urlsafe_b64decode(prefix).decode('utf-8', errors='replace')
+    
     def _parse_date(self, date_str: str) -> datetime:
         """Parse email date string to datetime object."""
         try:
-            # Try various date formats
-            for fmt in ['%a, %d %b %Y %H:%M:%S %z', '%d %b %Y %H:%M:%S %z']:
-                try:
-                    return datetime.strptime(date_str, fmt)
-                except ValueError:
-                    continue
-            
             # Fallback to current datetime if parsing fails
-            return datetime.now()
+            return parsedate_to_datetime(date_str) or datetime.now(timezone.utc)
         except Exception:
-            return datetime.now()
+            return datetime.now(timezone.utc)
     
     def mark_as_read(self, message_id: str) -> bool:
         """Mark an email as read."""
         try:
             # Modify the message labels
-            result = self.service.users().messages().modify(
+            result = self._execute(self.service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+            ))
             
             # Verify the operation by checking if UNREAD label is removed
             current_labels = result.get('labelIds', [])
@@ -126,11 +209,11 @@ class EmailHandler:
                 return False
             
             # Apply label to message
-            self.service.users().messages().modify(
+            self._execute(self.service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={'addLabelIds': [label_id]}
-            ).execute()
+            ))
             return True
         except Exception as e:
             print(f"Error applying label: {e}")
@@ -138,26 +221,29 @@ class EmailHandler:
     
     def _get_or_create_label(self, label_name: str) -> Optional[str]:
         """Get or create a Gmail label."""
+        key = label_name.lower()
         try:
-            # List all labels
-            results = self.service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
+            # Only list labels when the name isn't cached yet
+            if key not in self._label_cache:
+                results = self._execute(self.service.users().labels().list(userId='me'))
+                for label in results.get('labels', []):
+                    self._label_cache[label['name'].lower()] = label['id']
             
             # Check if label exists
-            for label in labels:
-                if label['name'].lower() == label_name.lower():
-                    return label['id']
+            if key in self._label_cache:
+                return self._label_cache[key]
             
             # Create new label
-            label = self.service.users().labels().create(
+            label = self._execute(self.service.users().labels().create(
                 userId='me',
                 body={
                     'name': label_name,
                     'labelListVisibility': 'labelShow',
                     'messageListVisibility': 'show'
                 }
-            ).execute()
+            ))
             
+            self._label_cache[key] = label['id']
             return label['id']
         except Exception as e:
             print(f"Error managing label: {e}")
@@ -166,33 +252,43 @@ class EmailHandler:
     def move_to_folder(self, message_id: str, folder: str) -> bool:
         """Move an email to a specified folder."""
         try:
-            # Map folder names to Gmail label IDs
-            folder_mapping = {
-                'inbox': 'INBOX',
-                'spam': 'SPAM',
-                'trash': 'TRASH',
-                'archive': None  # Removing INBOX label effectively archives the message
-            }
+            folder_mapping = self.FOLDER_LABELS
             
             if folder.lower() not in folder_mapping:
                 return False
             
             # Remove current labels
-            self.service.users().messages().modify(
+            self._execute(self.service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={'removeLabelIds': ['INBOX', 'SPAM', 'TRASH']}
-            ).execute()
+            ))
             
             # Add new label if not archiving
             if folder_mapping[folder.lower()]:
-                self.service.users().messages().modify(
+                self._execute(self.service.users().messages().modify(
                     userId='me',
                     id=message_id,
                     body={'addLabelIds': [folder_mapping[folder.lower()]]}
-                ).execute()
+                ))
             
             return True
         except Exception as e:
             print(f"Error moving message: {e}")
+            return False
+    
+    def bulk_modify(self, message_ids: List[str], add_labels: List[str], remove_labels: List[str]) -> bool:
+        """Apply the same label changes to several emails in one request."""
+        try:
+            self._execute(self.service.users().messages().batchModify(
+                userId='me',
+                body={
+                    'ids': message_ids,
+                    'addLabelIds': add_labels,
+                    'removeLabelIds': remove_labels
+                }
+            ))
+            return True
+        except Exception as e:
+            print(f"Error modifying messages: {e}")
             return False
\ No newline at end of file
@@ -6,112 +6,260 @@ Handles email rule processing and action execution.
 """
 
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
 from src.email.email_handler import EmailHandler
+from src.database.data_store import EmailDataStore, days_ago
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+class _EmailFrame:
+    """Emails of one processing run as a DataFrame, with derived columns cached."""
+    
+    def __init__(self, emails: List[Dict], now: int):
+        self.df = pd.DataFrame(emails)
+        # Fields missing from an email are treated as NULL
+        for column in EmailDataStore.RULE_FIELD_COLUMNS.values():
+            if column not in self.df.columns:
+                self.df[column] = None
+        self.now = now
+        self._folded = {}
+        # Column -> (needle -> matrix column, emails x needles hit matrix)
+        self._hits = {}
+    
+    def never(self, rows: Optional[pd.Index] = None) -> pd.Series:
+        """Return a mask matching none of the given emails (default: all)."""
+        return pd.Series(False, index=self.df.index if rows is None else rows)
+    
+    def folded(self, column: str) -> pd.Series:
+        """Return a column as case-folded strings, computed once per run."""
+        if column not in self._folded:
+            # NULL compares as empty text
+            self._folded[column] = self.df[column].fillna('').astype(str).str.casefold()
+        return self._folded[column]
+    
+    def index_substrings(self, column: str, needles: Set[str]):
+        """Find every needle in a column with one Aho-Corasick pass per email."""
+        needles = sorted(needle for needle in needles if needle)
+        automaton = ahocorasick.Automaton()
+        for i, needle in enumerate(needles):
+            automaton.add_word(needle, i)
+        automaton.make_automaton()
+        
+        hits = np.zeros((len(self.df), len(needles)), dtype=bool)
+        for row, text in enumerate(self.folded(column)):
+            for _, i in automaton.iter(text):
+                hits[row, i] = True
+        self._hits[column] = ({needle: i for i, needle in enumerate(needles)}, hits)
+    
+    def contains(self, column: str, needle: str, rows: pd.Index) -> pd.Series:
+        """Return which of the given emails contain a case-folded needle in a column."""
+        if column in self._hits:
+            positions, hits = self._hits[column]
+            if needle in positions:
+                return pd.Series(hits[self.df.index.get_indexer(rows), positions[needle]], index=rows)
+        return self.folded(column).loc[rows].str.contains(needle, regex=False)
 
 class RuleEngine:
     """Manages email rule processing and actions."""
     
-    def __init__(self, email_handler: EmailHandler):
+    def __init__(self, email_handler: EmailHandler, max_workers: int = 16):
         self.email_handler = email_handler
+        # Concurrent batchModify calls when applying actions
+        self.max_workers = max_workers
+    
+    # Distinct 'contains' values on one field needed before they are matched
+    # together with a single Aho-Corasick pass (requires pyahocorasick). The
+    # per-email automaton loop only beats one str.contains scan per value
+    # from around this many values on 50k emails
+    MULTI_PATTERN_THRESHOLD = 32
     
     def process_emails(self, emails: List[Dict], rules: List[Dict]) -> Dict[str, List[str]]:
         """Process emails against defined rules."""
+        # Relative date conditions all use the same reference time
+        now = int(time.time())
+        
+        # Fold the actions of every matching rule into one label change per
+        # email; each rule's actions are translated once, and only its
+        # matches are visited
+        changes = {}
+        for rule, message_ids in zip(rules, self._match_rules(emails, rules, now)):
+            steps = self._action_steps(rule['actions'])
+            for message_id in message_ids:
+                change = changes.setdefault(
+                    message_id, {'add': set(), 'remove': set(), 'actions': []}
+                )
+                self._fold_actions(change, steps)
+        
+        # Emails needing identical label changes share a batchModify call
+        groups = {}
+        for message_id, change in changes.items():
+            if change['actions']:
+                key = (tuple(sorted(change['add'])), tuple(sorted(change['remove'])))
+                groups.setdefault(key, []).append(message_id)
+        
+        limit = EmailHandler.BATCH_MODIFY_LIMIT
+        batches = [
+            (message_ids[start:start + limit], add_labels, remove_labels)
+            for (add_labels, remove_labels), message_ids in groups.items()
+            for start in range(0, len(message_ids), limit)
+        ]
+        
+        # The batches cover disjoint emails, so they can be sent concurrently;
+        # a single batch is sent from this thread to reuse its connection
+        if len(batches) <= 1:
+            succeeded = [self._apply_batch(*batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                succeeded = list(executor.map(lambda batch: self._apply_batch(*batch), batches))
+        
         results = {}
+        for (message_ids, _, _), ok in zip(batches, succeeded):
+            if ok:
+                for message_id in message_ids:
+                    results[message_id] = changes[message_id]['actions']
+        return results
+    
+    def _match_rules(self, emails: List[Dict], rules: List[Dict], now: int) -> List[List[str]]:
+        """Return the ids of the emails matching each rule, in rule order."""
+        if not emails:
+            return [[] for _ in rules]
+        
+        # Evaluate each condition as one vectorized mask over all emails
+        frame = _EmailFrame(emails, now)
         
-        for email in emails:
-            applied_actions = []
+        # Scan each email once for all 'contains' values of a field when
+        # there are enough of them to beat one substring scan per value
+        if ahocorasick is not None:
+            needles = {}
             for rule in rules:
-                if self._evaluate_rule(email, rule):
-                    actions = self._apply_actions(email, rule['actions'])
-                    applied_actions.extend(actions)
-            
-            if applied_actions:
-                results[email['message_id']] = applied_actions
+                for condition in rule.get('conditions', []):
+                    column = EmailDataStore.RULE_FIELD_COLUMNS.get(condition['field'])
+                    if condition['operation'] in ('contains', 'does not contain') and column is not None:
+                        needles.setdefault(column, set()).add(str(condition['value']).casefold())
+            for column, values in needles.items():
+                if len(values) >= self.MULTI_PATTERN_THRESHOLD:
+                    frame.index_substrings(column, values)
         
-        return results
+        return [
+            frame.df.loc[self._rule_mask(frame, rule), 'message_id'].tolist()
+            for rule in rules
+        ]
     
-    def _evaluate_rule(self, email: Dict, rule: Dict) -> bool:
-        """Evaluate if an email matches a rule's conditions."""
+    def _rule_mask(self, frame: '_EmailFrame', rule: Dict) -> pd.Series:
+        """Compute which emails match a rule's conditions."""
         conditions = rule.get('conditions', [])
         if not conditions:
-            return False
+            return frame.never()
         
-        match_type = rule.get('match_type', 'all').lower()
-        results = [self._check_condition(email, condition) for condition in conditions]
+        match_all = rule.get('match_type', 'all').lower() == 'all'
         
-        return all(results) if match_type == 'all' else any(results)
+        # Each condition only looks at the emails whose outcome is still open:
+        # for 'all' those that passed every condition so far, for 'any' those
+        # that matched none yet
+        matched = frame.never()
+        undecided = frame.df.index
+        for condition in conditions:
+            mask = self._condition_mask(frame, condition, undecided).to_numpy(dtype=bool)
+            if match_all:
+                undecided = undecided[mask]
+            else:
+                matched.loc[undecided[mask]] = True
+                undecided = undecided[~mask]
+            if undecided.empty:
+                break
+        
+        if match_all:
+            matched.loc[undecided] = True
+        return matched
     
-    def _check_condition(self, email: Dict, condition: Dict) -> bool:
-        """Check if an email matches a specific condition."""
+    def _condition_mask(self, frame: '_EmailFrame', condition: Dict, rows: pd.Index) -> pd.Series:
+        """Compute which of the given emails match a specific condition."""
         field = condition['field']
         operation = condition['operation']
         value = condition['value']
         
         # Map field names to database column names
-        field_mapping = {
-            'From': 'sender',
-            'Subject': 'subject',
-            'Message': 'content',
-            'Date received': 'received_date'
-        }
-        
-        if field not in field_mapping or field_mapping[field] not in email:
-            return False
+        column = EmailDataStore.RULE_FIELD_COLUMNS.get(field)
+        if column is None:
+            return frame.never(rows)
         
-        field_value = email[field_mapping[field]]
-        
-        # Handle date comparisons
-        if field == 'Date received':
+        # Handle date comparisons against cutoffs computed once
+        if field == 'Date received' and operation in ('is less than', 'is greater than'):
             try:
-                if not isinstance(field_value, datetime):
-                    field_value = datetime.fromisoformat(field_value)
-                days_old = (datetime.now() - field_value).days
-                
-                if operation == 'is less than':
-                    return days_old < int(value)
-                elif operation == 'is greater than':
-                    return days_old > int(value)
+                days = int(value)
             except (ValueError, TypeError):
-                return False
+                return frame.never(rows)
+            
+            timestamps = pd.to_numeric(frame.df.loc[rows, column], errors='coerce')
+            if operation == 'is less than':
+                return timestamps.gt(days_ago(days, frame.now))
+            return timestamps.le(days_ago(days + 1, frame.now))
         
         # Handle string comparisons
-        field_value = str(field_value).lower()
-        value = str(value).lower()
+        needle = str(value).casefold()
         
         if operation == 'contains':
-            return value in field_value
+            return frame.contains(column, needle, rows)
         elif operation == 'does not contain':
-            return value not in field_value
+            return ~frame.contains(column, needle, rows)
         elif operation == 'equals':
-            return field_value == value
+            return frame.folded(column).loc[rows].eq(needle)
         elif operation == 'does not equal':
-            return field_value != value
+            return frame.folded(column).loc[rows].ne(needle)
         
-        return False
+        return frame.never(rows)
     
-    def _apply_actions(self, email: Dict, actions: List[Dict]) -> List[str]:
-        """Apply actions to an email."""
-        applied_actions = []
-        
+    def _action_steps(self, actions: List[Dict]) -> List[Tuple[Set[str], Set[str], str]]:
+        """Translate actions into (add labels, remove labels, description) steps."""
+        steps = []
         for action in actions:
             action_type = action['type']
             action_value = action.get('value', '')
             
             if action_type == 'Move Message':
-                if self.email_handler.move_to_folder(email['message_id'], action_value.lower()):
-                    applied_actions.append(f"Moved to {action_value}")
+                folder = action_value.lower()
+                if folder not in EmailHandler.FOLDER_LABELS:
+                    continue
+                label = EmailHandler.FOLDER_LABELS[folder]
+                add = {label} if label else set()
+                remove = {'INBOX', 'SPAM', 'TRASH'} - add
+                description = f"Moved to {action_value}"
             
             elif action_type == 'Mark as Read':
-                if self.email_handler.mark_as_read(email['message_id']):
-                    applied_actions.append("Marked as read")
+                add, remove = set(), {'UNREAD'}
+                description = "Marked as read"
             
             elif action_type == 'Mark as Unread':
-                if self.email_handler.mark_as_unread(email['message_id']):
-                    applied_actions.append("Marked as unread")
-        
-        return applied_actions
+                add, remove = {'UNREAD'}, set()
+                description = "Marked as unread"
+            
+            else:
+                continue
+            
+            steps.append((add, remove, description))
+        return steps
+    
+    def _fold_actions(self, change: Dict, steps: List[Tuple[Set[str], Set[str], str]]):
+        """Fold action steps into an email's net label change, in order."""
+        for add, remove, description in steps:
+            change['add'] = (change['add'] - remove) | add
+            change['remove'] = (change['remove'] - add) | remove
+            change['actions'].append(description)
+    
+    def _apply_batch(self, message_ids: List[str], add_labels: Tuple[str, ...],
+                     remove_labels: Tuple[str, ...]) -> bool:
+        """Apply one net label change to a batch of emails."""
+        if not add_labels and not remove_labels:
+            return True
+        return self.email_handler.bulk_modify(message_ids, list(add_labels), list(remove_labels))
     
     def _compare_dates(self, date_value: datetime, days: int, comparison: str) -> bool:
         """Compare dates for date-based conditions."""
@@ -127,6 +275,15 @@ class RuleEngine:
         
         return False
     
+    @staticmethod
+    def needs_body(rules: List[Dict]) -> bool:
+        """Check whether any rule matches on the message content."""
+        return any(
+            condition.get('field') == 'Message'
+            for rule in rules
+            for condition in rule.get('conditions', [])
+        )
+    
     @staticmethod
     def load_rules(rules_file: str) -> List[Dict]:
         """Load rules from a JSON file."""
@@ -1,18 +1,95 @@
+import os
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
 from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 from ..auth.gmail_auth import GmailAuthManager
 from ..email.email_handler import EmailHandler
 from ..rules.rule_engine import RuleEngine
 from ..database.data_store import EmailDataStore
 
+# Streamlit reruns this script on every interaction; the resources below are
+# built once per server process and shared across reruns and sessions.
+
+@st.cache_resource
+def get_auth_manager() -> GmailAuthManager:
+    return GmailAuthManager()
+
+@st.cache_resource
+def get_data_store() -> EmailDataStore:
+    return EmailDataStore()
+
+@st.cache_resource
+def get_services() -> Tuple[EmailHandler, RuleEngine]:
+    service = get_auth_manager().initialize_gmail_service()
+    email_handler = EmailHandler(service)
+    return email_handler, RuleEngine(email_handler)
+
+# Page styles, including the add/remove condition buttons
+_CSS = """
+<style>
+.main > div {
+    padding: 2rem;
+    border-radius: 0.5rem;
+    background-color: #f8f9fa;
+}
+.stButton>button {
+    width: 100%;
+    border-radius: 0.3rem;
+    height: 3rem;
+}
+.stButton.plus-btn > button {
+    background-color: #28a745;
+    color: white;
+    padding: 0.5rem 1rem;
+    border-radius: 0.3rem;
+    margin-right: 0.5rem;
+}
+.stButton.minus-btn > button {
+    background-color: #dc3545;
+    color: white;
+    padding: 0.5rem 1rem;
+    border-radius: 0.3rem;
+}
+</style>
+"""
+
+# Most points drawn on the email timeline chart
+MAX_TIMELINE_POINTS = 500
+
+# Query results are cached per data store version, which only changes on
+# writes, so reruns in between skip SQLite entirely.
+
+@st.cache_data(max_entries=8)
+def cached_emails(limit: Optional[int], version: int) -> List[Dict]:
+    return get_data_store().get_emails(limit=limit)
+
+@st.cache_data(max_entries=8)
+def cached_emails_df(limit: Optional[int], version: int) -> pd.DataFrame:
+    return get_data_store().get_emails_df(limit=limit)
+
+@st.cache_data(max_entries=8)
+def cached_rules(version: int) -> List[Dict]:
+    return get_data_store().get_rules()
+
+# Sidebar icon, found relative to this file rather than the working directory
+GMAIL_ICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'assets', 'gmail.svg')
+
+@st.cache_data
+def _gmail_icon() -> Optional[str]:
+    try:
+        with open(GMAIL_ICON_PATH) as f:
+            return f.read()
+    except OSError:
+        return None
+
 class WebInterface:
     def __init__(self):
-        self.auth_manager = GmailAuthManager()
+        self.auth_manager = get_auth_manager()
         self.email_handler = None
         self.rule_engine = None
-        self.data_store = EmailDataStore()
+        self.data_store = get_data_store()
         self.setup_page()
 
     def setup_page(self):
@@ -22,66 +99,65 @@ class WebInterface:
             layout="wide",
             initial_sidebar_state="expanded"
         )
-        st.markdown("""
-        <style>
-        .main > div {
-            padding: 2rem;
-            border-radius: 0.5rem;
-            background-color: #f8f9fa;
-        }
-        .stButton>button {
-            width: 100%;
-            border-radius: 0.3rem;
-            height: 3rem;
-        }
-        </style>
-        """, unsafe_allow_html=True)
 
-    def initialize_services(self):
-        service = self.auth_manager.initialize_gmail_service()
-        if service:
-            self.email_handler = EmailHandler(service)
-            self.rule_engine = RuleEngine(self.email_handler)
-            return True
-        return False
+    def _is_authed(self) -> bool:
+        # Checked once per session; the auth buttons clear it to re-check
+        if 'authed' not in st.session_state:
+            st.session_state.authed = bool(self.auth_manager._load_saved_credentials())
+        return st.session_state.authed
+
+    def initialize_services(self, refresh: bool = False):
+        if refresh:
+            get_services.clear()
+        self.email_handler, self.rule_engine = get_services()
+        return self.email_handler.service is not None
 
     def render_sidebar(self):
+        # A fragment can't open st.sidebar itself, so it is called inside it
         with st.sidebar:
-            st.image("https://img.icons8.com/color/96/000000/gmail.png", width=50)
-            st.title("Email Rule Manager")
-            st.markdown("---")
-            
-            if not self.auth_manager._load_saved_credentials():
-                st.warning("Please authenticate to continue")
-                if st.button("🔐 Authenticate"):
-                    if self.initialize_services():
-                        st.success("✓ Authentication successful")
-                        st.rerun()
-            else:
-                if not self.email_handler:
-                    if self.initialize_services():
-                        st.success("✓ Services initialized")
-                    else:
-                        st.error("Failed to initialize services")
+            self._sidebar_fragment()
+
+    @st.fragment
+    def _sidebar_fragment(self):
+        icon = _gmail_icon()
+        if icon:
+            st.image(icon, width=50)
+        st.title("Email Rule Manager")
+        st.markdown("---")
+        
+        if not self._is_authed():
+            st.warning("Please authenticate to continue")
+            if st.button("🔐 Authenticate"):
+                st.session_state.pop('authed', None)
+                if self.initialize_services():
+                    st.success("✓ Authentication successful")
+                    st.rerun()
+        else:
+            if not self.email_handler:
+                if self.initialize_services():
+                    st.success("✓ Services initialized")
                 else:
-                    st.success("✓ Authenticated")
-                if st.button("🔄 Refresh"):
-                    if self.initialize_services():
-                        st.success("✓ Services refreshed")
-                        st.rerun()
-            
-            st.markdown("---")
-            st.markdown("### Quick Actions")
-            col1, col2 = st.columns(2)
-            with col1:
-                if st.button("📥 Fetch"):
-                    self.fetch_emails()
-            with col2:
-                if st.button("⚙️ Process"):
-                    self.process_rules()
+                    st.error("Failed to initialize services")
+            else:
+                st.success("✓ Authenticated")
+            if st.button("🔄 Refresh"):
+                st.session_state.pop('authed', None)
+                if self.initialize_services(refresh=True):
+                    st.success("✓ Services refreshed")
+                    st.rerun()
+        
+        st.markdown("---")
+        st.markdown("### Quick Actions")
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("📥 Fetch"):
+                self.fetch_emails()
+        with col2:
+            if st.button("⚙️ Process"):
+                self.process_rules()
 
     def fetch_emails(self):
-        if not self.auth_manager._load_saved_credentials():
+        if not self._is_authed():
             st.error("Please authenticate first")
             return
         
@@ -91,13 +167,18 @@ class WebInterface:
                 return
         
         with st.spinner("Fetching emails..."):
-            emails = self.email_handler.fetch_recent_emails()
-            for email in emails:
-                self.data_store.store_email(email)
-            st.success(f"Fetched {len(emails)} emails")
+            # Only download message bodies when a rule matches on them
+            need_body = RuleEngine.needs_body(cached_rules(self.data_store.version()))
+            emails = self.email_handler.fetch_recent_emails(need_body=need_body)
+            if self.data_store.store_emails(emails):
+                st.toast(f"Fetched {len(emails)} emails")
+                # The email tab sits outside the sidebar fragment, so rerun the app
+                st.rerun()
+            else:
+                st.error("Failed to store fetched emails")
 
     def process_rules(self):
-        if not self.auth_manager._load_saved_credentials():
+        if not self._is_authed():
             st.error("Please authenticate first")
             return
         
@@ -107,8 +188,8 @@ class WebInterface:
                 return
         
         with st.spinner("Processing rules..."):
-            emails = self.data_store.get_emails()
-            rules = self.data_store.get_rules()
+            emails = cached_emails(None, self.data_store.version())
+            rules = cached_rules(self.data_store.version())
             results = self.rule_engine.process_emails(emails, rules)
             # Store the results in session state
             st.session_state.rule_results = results
@@ -116,8 +197,9 @@ class WebInterface:
             # Display detailed processing information
             if results:
                 st.info("Rule processing details:")
+                email_by_id = {e['message_id']: e for e in emails}
                 for email_id, actions in results.items():
-                    email = next((e for e in emails if e['message_id'] == email_id), None)
+                    email = email_by_id.get(email_id)
                     if email and actions:
                         st.write(f"📧 {email['subject']}:")
                         st.write(f"Actions applied: {', '.join(actions)}")
@@ -131,22 +213,31 @@ class WebInterface:
         col1, col2 = st.columns([2, 1])
         
         with col1:
-            emails = self.data_store.get_emails(limit=25)
-            if emails:
-                df = pd.DataFrame(emails)
-                df['received_date'] = pd.to_datetime(df['received_date'], format='ISO8601')
-                
+            df = cached_emails_df(25, self.data_store.version())
+            if not df.empty:
                 # Add rule processing results if available
-                if hasattr(st.session_state, 'rule_results'):
-                    df['applied_actions'] = df['message_id'].map(lambda x: '\n'.join(st.session_state.rule_results.get(x, [])) or 'No actions')
+                rule_results = st.session_state.get('rule_results')
+                if rule_results is not None:
+                    actions_ser = pd.Series(
+                        {k: '\n'.join(v) for k, v in rule_results.items()},
+                        dtype=object
+                    )
+                    df['applied_actions'] = df['message_id'].map(actions_ser).fillna('No actions')
                     # Add visual indicator for processed emails
-                    df['status'] = df['applied_actions'].apply(lambda x: '✅ Processed' if x != 'No actions' else '⏳ Pending')
+                    df['status'] = np.where(df['applied_actions'].ne('No actions'), '✅ Processed', '⏳ Pending')
                 else:
                     df['applied_actions'] = 'Not processed'
                     df['status'] = '⏳ Pending'
                 
+                # Plotly is imported here so sessions that never show the chart skip loading it
+                import plotly.express as px
+                
+                # Plotly serializes every point, so large timelines are downsampled
+                df_plot = df
+                if len(df) > MAX_TIMELINE_POINTS:
+                    df_plot = df.sample(MAX_TIMELINE_POINTS, random_state=0)
                 fig = px.scatter(
-                    df,
+                    df_plot,
                     x='received_date',
                     y='subject',
                     color='status',
@@ -162,16 +253,16 @@ class WebInterface:
                 )
                 
                 # Display processing results section
-                if hasattr(st.session_state, 'rule_results'):
+                if rule_results is not None:
                     st.subheader("📋 Processing Results")
                     processed_emails = df[df['applied_actions'] != 'No actions']
                     if not processed_emails.empty:
                         st.write(f"Processed {len(processed_emails)} emails:")
-                        for _, email in processed_emails.iterrows():
-                            with st.expander(f"📧 {email['subject']}"):
-                                st.write(f"**From:** {email['sender']}")
+                        for email in processed_emails.itertuples(index=False):
+                            with st.expander(f"📧 {email.subject}"):
+                                st.write(f"**From:** {email.sender}")
                                 st.write(f"**Actions Applied:**")
-                                st.write(email['applied_actions'])
+                                st.write(email.applied_actions)
                     else:
                         st.info("No emails were affected by the rules.")
             else:
@@ -179,12 +270,13 @@ class WebInterface:
         
         with col2:
             st.subheader("Email Stats")
-            total_emails = len(emails)
-            unread = sum(1 for e in emails if not e['is_read'])
+            total_emails = len(df)
+            unread = int((~df['is_read']).sum())
             st.metric("Total Emails", total_emails)
             st.metric("Unread", unread)
             st.metric("Read", total_emails - unread)
 
+    @st.fragment
     def render_rules_section(self):
         st.header("📋 Rule Management")
         
@@ -194,34 +286,16 @@ class WebInterface:
             # Handle dynamic conditions outside the form
             num_conditions = st.session_state.get('num_conditions', 1)
             
-            # Add condition controls with better styling
-            st.markdown("""
-            <style>
-            .stButton.plus-btn > button {
-                background-color: #28a745;
-                color: white;
-                padding: 0.5rem 1rem;
-                border-radius: 0.3rem;
-                margin-right: 0.5rem;
-            }
-            .stButton.minus-btn > button {
-                background-color: #dc3545;
-                color: white;
-                padding: 0.5rem 1rem;
-                border-radius: 0.3rem;
-            }
-            </style>
-            """, unsafe_allow_html=True)
-            
+            # Add condition controls
             col1, col2, col3 = st.columns([8, 1, 1])
             with col2:
                 if st.button("+", key="add_condition", help="Add a new condition"):
                     st.session_state.num_conditions = num_conditions + 1
-                    st.rerun()
+                    st.rerun(scope="fragment")
             with col3:
                 if num_conditions > 1 and st.button("-", key="remove_condition", help="Remove last condition"):
                     st.session_state.num_conditions = num_conditions - 1
-                    st.rerun()
+                    st.rerun(scope="fragment")
             
             with st.form("rule_form", clear_on_submit=True):
                 st.subheader("New Rule")
@@ -231,26 +305,28 @@ class WebInterface:
                 st.write("If")
                 match_type = st.selectbox("", ["all", "any"], format_func=lambda x: f"{x} of the following conditions are met:")
                 
-                # Dynamic conditions
-                conditions = []
+                # Dynamic conditions, remembering each one's widget keys
+                condition_keys = []
                 for i in range(num_conditions):
+                    keys = (f"field_{i}", f"op_{i}", f"value_{i}")
+                    condition_keys.append(keys)
                     st.markdown(f"<div style='margin-top: 1rem; margin-bottom: 1rem;'><h4>Condition {i+1}</h4></div>", unsafe_allow_html=True)
                     col1, col2, col3 = st.columns([3, 3, 3])
                     
                     with col1:
-                        field = st.selectbox("Field", ["From", "Subject", "Date received"], key=f"field_{i}")
+                        field = st.selectbox("Field", ["From", "Subject", "Date received"], key=keys[0])
                     
                     with col2:
                         if field == "Date received":
-                            operation = st.selectbox("Operation", ["is less than", "is greater than"], key=f"op_{i}")
+                            st.selectbox("Operation", ["is less than", "is greater than"], key=keys[1])
                         else:
-                            operation = st.selectbox("Operation", ["contains", "does not contain", "equals"], key=f"op_{i}")
+                            st.selectbox("Operation", ["contains", "does not contain", "equals"], key=keys[1])
                     
                     with col3:
                         if field == "Date received":
-                            value = st.number_input("Days old", min_value=1, value=2, key=f"value_{i}")
+                            st.number_input("Days old", min_value=1, value=2, key=keys[2])
                         else:
-                            value = st.text_input("Value", key=f"value_{i}")
+                            st.text_input("Value", key=keys[2])
                 
                 st.subheader("Actions")
                 action_type = st.selectbox("Action", ["Move Message", "Mark as Read"])
@@ -263,13 +339,12 @@ class WebInterface:
                         action_value = st.selectbox("", ["Inbox", "Spam", "Trash", "Archive"])
                 
                 if st.form_submit_button("Create Rule"):
-                    # Collect all conditions
-                    conditions = []
-                    for i in range(st.session_state.get('num_conditions', 1)):
-                        field = st.session_state[f"field_{i}"]
-                        operation = st.session_state[f"op_{i}"]
-                        value = st.session_state[f"value_{i}"]
-                        conditions.append({"field": field, "operation": operation, "value": value})
+                    # Collect all conditions from the keys rendered above
+                    state = st.session_state
+                    conditions = [
+                        {"field": state[field_key], "operation": state[op_key], "value": state[value_key]}
+                        for field_key, op_key, value_key in condition_keys
+                    ]
                     
                     # Create action
                     action = {
@@ -291,7 +366,7 @@ class WebInterface:
                         st.error("Failed to create rule")
         
         with tab2:
-            rules = self.data_store.get_rules()
+            rules = cached_rules(self.data_store.version())
             for rule in rules:
                 with st.expander(f"📌 {rule['name']}"):
                     st.json(rule)
@@ -301,9 +376,10 @@ class WebInterface:
                             st.rerun()
 
     def run(self):
+        st.markdown(_CSS, unsafe_allow_html=True)
         self.render_sidebar()
         
-        if self.auth_manager._load_saved_credentials():
+        if self._is_authed():
             self.initialize_services()
             tab1, tab2 = st.tabs(["📧 Emails", "📋 Rules"])
             
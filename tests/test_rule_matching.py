@@ -0,0 +1,125 @@
+"""Check vectorized rule matching against a plain per-email evaluation."""
+
+import itertools
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import src.rules.rule_engine as rule_engine
+from src.database.data_store import EmailDataStore, days_ago
+from src.rules.rule_engine import RuleEngine
+
+class RecordingHandler:
+    """Stands in for EmailHandler, accepting every batchModify call."""
+
+    def bulk_modify(self, message_ids, add_labels, remove_labels):
+        return True
+
+def make_email(message_id, subject, sender, content, days_old):
+    received = datetime.now(timezone.utc) - timedelta(days=days_old, hours=6)
+    return {
+        'message_id': message_id,
+        'subject': subject,
+        'sender': sender,
+        'recipient': 'me@example.com',
+        'received_date': received.isoformat(),
+        'content': content,
+        'is_read': False,
+        'labels': ['INBOX', 'UNREAD']
+    }
+
+EMAILS = [
+    make_email('1', 'Über Angebot', 'Émile <emile@example.fr>', 'Guten Tag', 0),
+    make_email('2', 'Weekly report', 'Bob <bob@example.com>', None, 1),
+    make_email('3', None, 'ÉMILE <EMILE@EXAMPLE.FR>', 'Straße gesperrt', 3),
+    make_email('4', 'STRASSE news', 'alice@example.com', '50% off_today', 5),
+    make_email('5', 'none', 'None', '', 9),
+]
+
+VALUES = ['über', 'ÜBER ANGEBOT', 'émile', 'ÉMILE', 'straße', 'strasse', 'none', '50%', '_', '']
+STRING_CONDITIONS = [
+    {'field': field, 'operation': operation, 'value': value}
+    for field in ('From', 'Subject', 'Message')
+    for operation in ('contains', 'does not contain', 'equals', 'does not equal')
+    for value in VALUES
+]
+DATE_CONDITIONS = [
+    {'field': 'Date received', 'operation': operation, 'value': days}
+    for operation in ('is less than', 'is greater than')
+    for days in (1, 2, 4, 'x')
+]
+
+def make_rules():
+    conditions = STRING_CONDITIONS + DATE_CONDITIONS
+    rules = [
+        {'match_type': 'all', 'conditions': [condition],
+         'actions': [{'type': 'Mark as Read', 'value': ''}]}
+        for condition in conditions
+    ]
+    # Mixed rules exercise the early exit on undecided emails
+    for i, (first, second) in enumerate(itertools.combinations(conditions[::7], 2)):
+        rules.append({
+            'match_type': 'any' if i % 2 else 'all',
+            'conditions': [first, second, DATE_CONDITIONS[i % len(DATE_CONDITIONS)]],
+            'actions': [{'type': 'Move Message', 'value': 'Trash'}]
+        })
+    return rules
+
+def reference_match(email, condition, now):
+    """Evaluate one condition on one email: NULL is empty text, case is folded."""
+    column = EmailDataStore.RULE_FIELD_COLUMNS[condition['field']]
+    operation = condition['operation']
+    if column == 'received_ts':
+        try:
+            days = int(condition['value'])
+        except ValueError:
+            return False
+        if operation == 'is less than':
+            return email[column] > days_ago(days, now)
+        return email[column] <= days_ago(days + 1, now)
+
+    text = (email[column] or '').casefold()
+    needle = str(condition['value']).casefold()
+    return {
+        'contains': needle in text,
+        'does not contain': needle not in text,
+        'equals': text == needle,
+        'does not equal': text != needle,
+    }[operation]
+
+@pytest.fixture
+def stored_emails():
+    data_store = EmailDataStore(':memory:')
+    assert data_store.store_emails(EMAILS)
+    yield data_store.get_emails()
+    data_store.close()
+
+@pytest.mark.parametrize('multi_pattern', [True, False])
+def test_vectorized_matching_agrees_with_reference(stored_emails, monkeypatch, multi_pattern):
+    if multi_pattern:
+        monkeypatch.setattr(RuleEngine, 'MULTI_PATTERN_THRESHOLD', 1)
+    else:
+        monkeypatch.setattr(rule_engine, 'ahocorasick', None)
+
+    rules = make_rules()
+    now = int(time.time())
+    matches = RuleEngine(RecordingHandler())._match_rules(stored_emails, rules, now)
+    for rule, matched_ids in zip(rules, matches):
+        combine = all if rule['match_type'] == 'all' else any
+        expected = [
+            email['message_id'] for email in stored_emails
+            if combine(reference_match(email, condition, now) for condition in rule['conditions'])
+        ]
+        assert matched_ids == expected, rule
+
+def test_non_ascii_case_folding(stored_emails):
+    engine = RuleEngine(RecordingHandler())
+    rules = [
+        {'match_type': 'all', 'conditions': [{'field': 'Subject', 'operation': 'contains', 'value': 'über'}],
+         'actions': [{'type': 'Mark as Read', 'value': ''}]},
+        {'match_type': 'all', 'conditions': [{'field': 'From', 'operation': 'contains', 'value': 'ÉMILE'}],
+         'actions': [{'type': 'Mark as Read', 'value': ''}]},
+    ]
+    assert set(engine.process_emails(stored_emails, rules[:1])) == {'1'}
+    assert set(engine.process_emails(stored_emails, rules[1:])) == {'1', '3'}